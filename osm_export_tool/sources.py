@@ -1,18 +1,192 @@
+import functools
+import http.client
 import json
 import os
+import queue
 import shutil
 import subprocess
 import tempfile
+import threading
+import weakref
+from collections import defaultdict
 from xml.dom import ValidationErr
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import Timeout
+from urllib3.exceptions import ProtocolError
+from urllib3.util.retry import Retry
 from string import Template
 from osm_export_tool.sql import to_prefix
 from urllib.parse import urlparse
 import shapely.geometry
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# galaxy request bodies carry the whole export geometry, encode them with orjson when it is installed
+if orjson:
+    def _dumps(obj):
+        return orjson.dumps(obj)
+else:
+    def _dumps(obj):
+        return json.dumps(obj,separators=(',',':')).encode()
 
 # path must return a path to an .osm.pbf or .osm.xml on the filesystem
 
+def _retrying_session(pool_connections=1,pool_maxsize=1):
+    # overpass and galaxy both turn requests away with 429/502/503 under load, back off and retry those.
+    # POSTs start a query or export on the server, so read errors/timeouts and 504s are not retried:
+    # the request may still be running there and re-sending it would only add load
+    retry = dict(total=5,read=False,status_forcelist=[429,502,503],backoff_factor=1.0,respect_retry_after_header=True,raise_on_status=False)
+    try:
+        retry = Retry(allowed_methods=None,**retry)
+    except TypeError: # urllib3 < 1.26
+        retry = Retry(method_whitelist=False,**retry)
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_connections,pool_maxsize=pool_maxsize,max_retries=retry)
+    session.mount('http://',adapter)
+    session.mount('https://',adapter)
+    return session
+
+class _ResumableResponse:
+    # file-like body of a streamed POST, if the connection drops mid-transfer the request is re-sent
+    # asking only for the missing tail. the query result can change between runs, so this is only
+    # done when the first response carries a validator for If-Range, and the 206 must continue the
+    # same uncompressed bytes at the current offset
+    max_resumes = 5
+
+    def __init__(self,session,url,data,headers):
+        self._session = session
+        self._url = url
+        self._data = data
+        self._headers = headers
+        self._offset = 0
+        self._resumes = 0
+        self._response = self._post(headers)
+        self._validator = self.validator(self._response.headers)
+
+    def _post(self,headers):
+        r = self._session.post(self._url,data=self._data,headers=headers,stream=True)
+        r.raw.decode_content = True
+        return r
+
+    @staticmethod
+    def validator(headers):
+        # If-Range only accepts a strong etag
+        etag = headers.get('ETag')
+        if etag and not etag.startswith('W/'):
+            return etag
+        return headers.get('Last-Modified')
+
+    def _resumable(self):
+        # offsets into a compressed body can not be resumed after decoding
+        h = self._response.headers
+        return (h.get('Accept-Ranges') == 'bytes' and h.get('Content-Encoding','identity') == 'identity'
+            and self._validator is not None and self._resumes < self.max_resumes)
+
+    def _resume(self):
+        self._resumes += 1
+        self._response.close()
+        self._response = self._post({**self._headers,'Accept-Encoding':'identity','Range':'bytes={0}-'.format(self._offset),'If-Range':self._validator})
+        h = self._response.headers
+        if self._response.status_code != 206:
+            raise ValueError('Overpass did not resume the response at byte {0}, status {1}'.format(self._offset,self._response.status_code))
+        if h.get('Content-Encoding','identity') != 'identity':
+            raise ValueError('Overpass resumed the response with Content-Encoding {0}'.format(h['Content-Encoding']))
+        if not h.get('Content-Range','').startswith('bytes {0}-'.format(self._offset)):
+            raise ValueError('Overpass resumed the response at {0}, expected byte {1}'.format(h.get('Content-Range'),self._offset))
+
+    def read(self,amt=None):
+        while True:
+            try:
+                chunk = self._response.raw.read(amt)
+            except (ProtocolError,http.client.IncompleteRead):
+                if not self._resumable():
+                    raise
+                self._resume()
+                continue
+            self._offset += len(chunk)
+            return chunk
+
+    def close(self):
+        self._response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+def _freeze(expr):
+    # prefix expressions hold lists for IN values, make them hashable
+    if isinstance(expr,(list,tuple)):
+        return tuple(_freeze(e) for e in expr)
+    return expr
+
+def _memoized(func):
+    # caches a classmethod result per mapping/theme object, for as long as that object lives
+    cache = weakref.WeakKeyDictionary()
+    @functools.wraps(func)
+    def wrapper(cls,obj):
+        results = cache.setdefault(obj,{})
+        if cls not in results:
+            results[cls] = func(cls,obj)
+        return results[cls]
+    return wrapper
+
+def _osmium_part(prefix):
+    op = prefix[0]
+    if op == '=':
+        return ["{0}={1}".format(prefix[1],prefix[2])]
+    if op == '!=':
+        return ["{0}!={1}".format(prefix[1],prefix[2])]
+    if op in ['<','>','<=','>='] or op == 'notnull':
+        raise ValueError('{0} where clause not supported'.format(op))
+    if op == 'in':
+        x = "{0}={1}".format(prefix[1],','.join(prefix[2]))
+        return [x]
+
+# force quoting of strings to handle keys with colons
+def _overpass_part(prefix):
+    op = prefix[0]
+    if op == '=':
+        return ["['{0}'='{1}']".format(prefix[1],prefix[2])]
+    if op == '!=':
+        return ["['{0}'!='{1}']".format(prefix[1],prefix[2])]
+    if op in ['<','>','<=','>='] or op == 'notnull':
+        return ["['{0}']".format(prefix[1])]
+    if op == 'in':
+        x = "['{0}'~'{1}']".format(prefix[1],'|'.join(prefix[2]))
+        return [x]
+
+def _galaxy_part(prefix):
+    op = prefix[0]
+    if op == '=':
+        return [{prefix[1]:[prefix[2]]}]
+    if op == '!=': #fixme this will require improvement in galaxy api is not implemented yet
+        return []
+        # return ["['{0}'!='{1}']".format(prefix[1],prefix[2])]
+    if op in ['<','>','<=','>='] or op == 'notnull':
+        return [{prefix[1]:[]}]
+    if op == 'in':
+        return [{prefix[1]:list(prefix[2])}]
+
+# hootenanny reads overpass QL
+_PART_FLAVORS = {'osmium':_osmium_part,'overpass':_overpass_part,'galaxy':_galaxy_part,'hoot':_overpass_part}
+
+# flattens a frozen prefix expression into the per-provider tag filter parts
+@functools.lru_cache(maxsize=4096)
+def _parts_cached(expr, flavor):
+    part = _PART_FLAVORS[flavor]
+    def _parts(prefix):
+        op = prefix[0]
+        if op == 'and' or op == 'or':
+            return _parts(prefix[1]) + _parts(prefix[2])
+        return part(prefix)
+    return tuple(_parts(expr))
+
 class Pbf:
     def __init__(self,path):
         self._path = path
@@ -34,8 +208,8 @@ class OsmExpress:
 
     def fetch(self):
         region_json = os.path.join(self.tempdir,'region.json')
-        with open(region_json,'w') as f:
-            f.write(json.dumps(shapely.geometry.mapping(self.geom)))
+        with open(region_json,'w',buffering=1<<20) as f:
+            json.dump(shapely.geometry.mapping(self.geom),f,separators=(',',':'))
         subprocess.check_call([self.osmx_path,'extract',self.db_path,self.output_path,'--region',region_json])
         os.remove(region_json)
 
@@ -58,20 +232,7 @@ class OsmiumTool:
 
     @classmethod
     def parts(cls, expr):
-        def _parts(prefix):
-            op = prefix[0]
-            if op == '=':
-                return ["{0}={1}".format(prefix[1],prefix[2])]
-            if op == '!=':
-                return ["{0}!={1}".format(prefix[1],prefix[2])]
-            if op in ['<','>','<=','>='] or op == 'notnull':
-                raise ValueError('{0} where clause not supported'.format(op))
-            if op == 'in':
-                x = "{0}={1}".format(prefix[1],','.join(prefix[2]))
-                return [x]
-            if op == 'and' or op == 'or':
-                return _parts(prefix[1]) + _parts(prefix[2])
-        return _parts(expr)
+        return list(_parts_cached(_freeze(expr),'osmium'))
 
     @staticmethod
     def get_element_filter(theme, part):
@@ -86,6 +247,7 @@ class OsmiumTool:
         return elements
 
     @classmethod
+    @_memoized
     def filters(cls,mapping):
         filters_set = set()
         tags = set()
@@ -93,22 +255,19 @@ class OsmiumTool:
             prefix = t.matcher.expr
             parts = cls.parts(prefix)
             for part in parts:
-                [filters_set.add(e) for e in OsmiumTool.get_element_filter(t, part)]
+                filters_set.update(OsmiumTool.get_element_filter(t, part))
                 key = [t for t in t.keys if t in part]
                 if len(key) == 1:
                     tags.add(key[0])
 
-        return filters_set
+        return frozenset(filters_set)
 
     def tags_filter(self, filters, planet_as_source):
         source_path = self.output_path
         if planet_as_source is True:
             source_path = self.source_path
 
-        cmd = [self.osmium_path,'tags-filter',source_path,'-o',self.output_path]
-
-        for f in filters:
-            cmd.insert(3, f)
+        cmd = [self.osmium_path,'tags-filter',source_path,*filters,'-o',self.output_path]
 
         if planet_as_source is False:
             cmd.append('--overwrite')
@@ -117,8 +276,8 @@ class OsmiumTool:
 
     def fetch(self):
         region_json = os.path.join(self.tempdir,'region.json')
-        with open(region_json,'w') as f:
-            f.write(json.dumps({'type':'Feature','geometry':shapely.geometry.mapping(self.geom)}))
+        with open(region_json,'w',buffering=1<<20) as f:
+            json.dump({'type':'Feature','geometry':shapely.geometry.mapping(self.geom)},f,separators=(',',':'))
         subprocess.check_call([self.osmium_path,'extract','-p',region_json,self.source_path,'-o',self.output_path,'--overwrite'])
         os.remove(region_json)
 
@@ -140,6 +299,7 @@ class OsmiumTool:
 
 class Overpass:
     @classmethod
+    @_memoized
     def filters(cls,mapping):
         nodes = set()
         ways = set()
@@ -147,79 +307,85 @@ class Overpass:
         for t in mapping.themes:
             parts = cls.parts(t.matcher.expr)
             if t.points:
-                for part in parts:
-                    nodes.add(part)
+                nodes.update(parts)
             if t.lines:
-                for part in parts:
-                    ways.add(part)
+                ways.update(parts)
             if t.polygons:
-                for part in parts:
-                    ways.add(part)
-                    relations.add(part)
-        return nodes,ways,relations
+                ways.update(parts)
+                relations.update(parts)
+        # results are cached and shared between callers
+        return frozenset(nodes),frozenset(ways),frozenset(relations)
+
+    # filters shared by nodes, ways and relations are queried once with nwr,
+    # only the remainder gets per-element statements
+    @classmethod
+    def union_filters(cls,mapping):
+        nodes,ways,relations = cls.filters(mapping)
+        nwr = nodes & ways & relations
+        return nwr,nodes - nwr,ways - nwr,relations - nwr
 
-    # force quoting of strings to handle keys with colons
     @classmethod
     def parts(cls, expr):
-        def _parts(prefix):
-            op = prefix[0]
-            if op == '=':
-                return ["['{0}'='{1}']".format(prefix[1],prefix[2])]
-            if op == '!=':
-                return ["['{0}'!='{1}']".format(prefix[1],prefix[2])]
-            if op in ['<','>','<=','>='] or op == 'notnull':
-                return ["['{0}']".format(prefix[1])]
-            if op == 'in':
-                x = "['{0}'~'{1}']".format(prefix[1],'|'.join(prefix[2]))
-                return [x]
-            if op == 'and' or op == 'or':
-                return _parts(prefix[1]) + _parts(prefix[2])
-        return _parts(expr)
+        return list(_parts_cached(_freeze(expr),'overpass'))
 
     @classmethod
     def sql(cls,str):
         return cls.parts(to_prefix(str))
 
-    def __init__(self,hostname,geom,path,use_existing=True,tempdir=None,osmconvert_path='osmconvert',mapping=None,use_curl=False):
+    # a polygon repeated in every tag statement can make the query itself megabytes long. past this size
+    # the statements use the short bbox and the matches are clipped to geom once. that trades query size
+    # for a larger intermediate set: for concave or diagonal regions the bbox can hold far more than the
+    # polygon, which counts against [maxsize] and [timeout], so small queries keep geom per statement
+    max_repeated_geom = 1<<20
+
+    # recursing with >> covers both the nodes of ways and the members of relations
+    @classmethod
+    def mapping_query(cls,mapping,bbox,geom):
+        query = """(
+                {0}
+            )->.candidates;
+            {1}
+            (._;>>;>;)"""
+        nwr,nodes,ways,relations = cls.union_filters(mapping)
+        count = len(nwr) + len(nodes) + len(ways) + len(relations)
+        if geom != bbox and len(geom) * count > cls.max_repeated_geom:
+            location,clip = bbox,'nwr.candidates({0});'.format(geom)
+        else:
+            location,clip = geom,'.candidates;'
+        statements = ['nwr({0}){1};'.format(location,f) for f in nwr]
+        statements += ['node({0}){1};'.format(location,f) for f in nodes]
+        statements += ['way({0}){1};'.format(location,f) for f in ways]
+        statements += ['relation({0}){1};'.format(location,f) for f in relations]
+        return query.format('\n'.join(statements),clip)
+
+    def __init__(self,hostname,geom,path,use_existing=True,tempdir=None,osmconvert_path='osmconvert',mapping=None,use_curl=False,osmium_path='osmium'):
         self.hostname = hostname
+        self._interpreter_url = hostname.rstrip('/') + '/api/interpreter'
         self._path = path
         self.geom = geom
         self.use_existing = use_existing
         self.osmconvert_path = osmconvert_path
-        self.tmp_path = os.path.join(tempdir,'tmp.osm.xml')
+        self.osmium_path = osmium_path
         self.mapping = mapping
         self.use_curl = use_curl
         self.tempdir = tempdir
+        self._session = _retrying_session()
 
     def fetch(self):
         base_template = Template('[maxsize:$maxsize][timeout:$timeout];$query;out meta;')
 
+        minx, miny, maxx, maxy = self.geom.bounds
+        west, south, east, north = max(minx,-180), max(miny,-90), min(maxx,180), min(maxy,90)
+        bbox = '{1},{0},{3},{2}'.format(west, south, east, north)
         if self.geom.geom_type == 'Polygon':
-            geom = 'poly:"{0}"'.format(' '.join(['{1} {0}'.format(*x) for x in self.geom.exterior.coords]))
+            # overpass wants "lat lon lat lon ...", swap and flatten the vertices in numpy instead of formatting each one
+            coords = np.asarray(self.geom.exterior.coords)[:,[1,0]]
+            geom = 'poly:"{0}"'.format(' '.join(map(str,coords.ravel().tolist())))
         else:
-            bounds = self.geom.bounds
-            west = max(bounds[0], -180)
-            south = max(bounds[1], -90)
-            east = min(bounds[2], 180)
-            north = min(bounds[3], 90)
-            geom = '{1},{0},{3},{2}'.format(west, south, east, north)
+            geom = bbox
 
         if self.mapping:
-            query = """(
-                (
-                    {0}
-                );
-                (
-                    {1}
-                );>;
-                (
-                    {2}
-                );>>;>;)"""
-            nodes,ways,relations = Overpass.filters(self.mapping)
-            nodes = '\n'.join(['node({0}){1};'.format(geom,f) for f in nodes])
-            ways = '\n'.join(['way({0}){1};'.format(geom,f) for f in ways])
-            relations = '\n'.join(['relation({0}){1};'.format(geom,f) for f in relations])
-            query = query.format(nodes,ways,relations)
+            query = Overpass.mapping_query(self.mapping,bbox,geom)
         else:
             query = '(node({0});<;>>;>;)'.format(geom)
 
@@ -228,25 +394,90 @@ class Overpass:
         if self.use_curl:
             with open(os.path.join(self.tempdir,'query.txt'),'w') as query_txt:
                 query_txt.write(data)
-            subprocess.check_call(['curl','-X','POST','-d','@'+os.path.join(self.tempdir,'query.txt'),os.path.join(self.hostname,'api','interpreter'),'-o',self.tmp_path])
+            # -f makes curl exit non-zero on HTTP errors instead of printing the error page
+            cmd = ['curl','-f','--compressed','-X','POST','-d','@'+os.path.join(self.tempdir,'query.txt'),self._interpreter_url,'-o','-']
+            with subprocess.Popen(cmd,stdout=subprocess.PIPE) as curl:
+                try:
+                    head = curl.stdout.read(8192)
+                    # an HTTP error leaves stdout empty, report curl's failure rather than the converter's
+                    if not head and curl.wait() != 0:
+                        raise subprocess.CalledProcessError(curl.returncode,cmd)
+                    Overpass.check_sample(head)
+                    partial = self.convert_stream(head, curl.stdout)
+                except ValidationErr as e:
+                    # closing stdout stops curl if it is still writing, exiting 23 or by SIGPIPE because of us.
+                    # any other failure of curl is what the converter choked on
+                    curl.stdout.close()
+                    if curl.wait() not in (0,23,-13):
+                        raise subprocess.CalledProcessError(curl.returncode,cmd) from e
+                    raise
+                except BaseException:
+                    curl.kill()
+                    raise
+            # a short download converts fine, only move it into place if curl finished cleanly
+            if curl.returncode != 0:
+                os.remove(partial)
+                raise subprocess.CalledProcessError(curl.returncode,cmd)
+            os.replace(partial,self._path)
         else:
-            with requests.post(os.path.join(self.hostname,'api','interpreter'),data=data, stream=True) as r:
-                
-                with open(self.tmp_path, 'wb') as f:
-                    shutil.copyfileobj(r.raw, f)
-
-        with open(self.tmp_path,'r') as f:
-            sample = [next(f) for x in range(6)]
-            if 'DOCTYPE html' in sample[1]:
-                raise Exception('Overpass failure')
-            if 'remark' in sample[5]:
-                raise Exception(sample[5])
-        # run osmconvert on the file
+            # pipe the response straight into the converter instead of round-tripping through a tmp file
+            # overpass can gzip the response, r.raw then inflates it while streaming
+            with _ResumableResponse(self._session,self._interpreter_url,data,{'Accept-Encoding':'gzip, deflate'}) as r:
+                head = r.read(8192)
+                Overpass.check_sample(head)
+                os.replace(self.convert_stream(head, r),self._path)
+
+    @staticmethod
+    def check_sample(head):
+        sample = head.decode('utf-8','replace').splitlines()
+        if len(sample) > 1 and 'DOCTYPE html' in sample[1]:
+            raise Exception('Overpass failure')
+        if len(sample) > 5 and 'remark' in sample[5]:
+            raise Exception(sample[5])
+
+    def xml_output(self):
+        return self._path.endswith(('.osm','.osm.xml'))
+
+    def convert_cmd(self, source, output):
+        # libosmium encodes pbf blocks on several threads, osmconvert is the fallback
+        if shutil.which(self.osmium_path):
+            return [self.osmium_path,'cat','-F','osm','-f','pbf','--overwrite','-o',output,source]
+        return [self.osmconvert_path,source,'--out-pbf','-o='+output]
+
+    # converts into a file in tempdir and returns its path once the stream is complete, the caller
+    # moves it onto self._path. a failed download never leaves an output that path() would reuse
+    def convert_stream(self, head, stream):
+        fd, partial = tempfile.mkstemp(dir=self.tempdir,suffix='.osm.xml' if self.xml_output() else '.osm.pbf')
+        os.close(fd)
         try:
-            subprocess.check_call([self.osmconvert_path,self.tmp_path,'--out-pbf','-o='+self._path])
-        except subprocess.CalledProcessError as e:
-            raise ValidationErr(e)
-        os.remove(self.tmp_path)
+            if self.xml_output():
+                with open(partial,'wb') as f:
+                    f.write(head)
+                    shutil.copyfileobj(stream, f, length=1<<20)
+                return partial
+            cmd = self.convert_cmd('-',partial)
+            proc = subprocess.Popen(cmd,stdin=subprocess.PIPE)
+            try:
+                proc.stdin.write(head)
+                shutil.copyfileobj(stream, proc.stdin, length=1<<20)
+            except BrokenPipeError:
+                pass # the converter exited early, the return code below reports why
+            except BaseException:
+                # don't let the converter finish a truncated file from the EOF below
+                proc.kill()
+                proc.wait()
+                raise
+            finally:
+                try:
+                    proc.stdin.close()
+                except BrokenPipeError:
+                    pass
+            if proc.wait() != 0:
+                raise ValidationErr(subprocess.CalledProcessError(proc.returncode,cmd))
+        except BaseException:
+            os.remove(partial)
+            raise
+        return partial
 
     def path(self):
         if os.path.isfile(self._path) and self.use_existing:
@@ -260,61 +491,33 @@ class Galaxy:
     """Transfers Yaml Language to Galaxy Query Make a request and sends response back from fetch()"""
     
     @classmethod
+    @_memoized
     def hdx_filters(cls,t):
         geometryType=[]
-        point_filter,line_filter,poly_filter={},{},{}
+        point_filter,line_filter,poly_filter=defaultdict(dict),defaultdict(dict),defaultdict(dict)
         point_columns,line_columns,poly_columns=[],[],[]
         parts = cls.parts(t.matcher.expr)
         if t.points:
             point_columns=cls.attribute_filter(t)
             geometryType.append("point")
-            for part in parts:
-                part_dict=json.loads(f"""{'{'}{part.strip()}{'}'}""")
-                for key,value in part_dict.items():
-                    if key not in point_filter:
-                        point_filter[key] = value
-                    else:
-                        point_filter[key] += value # dictionary already have that key defined update and add the value
+            cls.merge_parts(point_filter,parts)
         if t.lines:
-            ways_select_filter=cls.attribute_filter(t)
             line_columns=cls.attribute_filter(t)
-
             geometryType.append("line") # Galaxy supports both linestring and multilinestring, getting them both since export tool only has line but with galaxy it will also deliver multilinestring features 
-            for part in parts:
-                part_dict=json.loads(f"""{'{'}{part.strip()}{'}'}""")
-                for key,value in part_dict.items():
-                    if key not in line_filter:
-                        line_filter[key] = value
-                    else:
-                        line_filter[key] += value
+            cls.merge_parts(line_filter,parts)
         if t.polygons:
             poly_columns=cls.attribute_filter(t)
             geometryType.append("polygon" ) # Galaxy also supports multipolygon and polygon , passing them both since export tool has only polygon supported
-            for part in parts:
-                part_dict=json.loads(f"""{'{'}{part.strip()}{'}'}""")
-                for key,value in part_dict.items():
-                    if key not in poly_filter:
-                        poly_filter[key] = value
-                    else:
-                        if poly_filter.get(key) != []: #only add other values if not null condition is not applied to that key
-                            if value == [] : # if incoming value is not null i.e. key = * ignore previously added values
-                                poly_filter[key] = value
-                            else:
-                                poly_filter[key] += value # if value was not previously = * then and value is not =* then add values 
-
-        if point_filter:
-            point_filter=cls.remove_duplicates(point_filter)
-        if line_filter:
-            line_filter=cls.remove_duplicates(line_filter)
-        if poly_filter:
-            poly_filter=cls.remove_duplicates(poly_filter)
-        return point_filter,line_filter,poly_filter,geometryType,point_columns,line_columns,poly_columns
+            cls.merge_parts(poly_filter,parts,sticky_notnull=True)
+
+        return cls.to_lists(point_filter),cls.to_lists(line_filter),cls.to_lists(poly_filter),geometryType,point_columns,line_columns,poly_columns
 
     
     @classmethod
+    @_memoized
     def filters(cls,mapping):
         geometryType=[]
-        point_filter,line_filter,poly_filter={},{},{}
+        point_filter,line_filter,poly_filter=defaultdict(dict),defaultdict(dict),defaultdict(dict)
         point_columns,line_columns,poly_columns=[],[],[]
         
         for t in mapping.themes:
@@ -323,72 +526,75 @@ class Galaxy:
             if t.points:
                 point_columns=cls.attribute_filter(t)
                 geometryType.append("point")
-                for part in parts:
-                    part_dict=json.loads(f"""{'{'}{part.strip()}{'}'}""")
-                    for key,value in part_dict.items():
-                        if key not in point_filter:
-                            point_filter[key] = value
-                        else:
-                            point_filter[key] += value # dictionary already have that key defined update and add the value
+                cls.merge_parts(point_filter,parts)
             if t.lines:
-                ways_select_filter=cls.attribute_filter(t)
                 line_columns=cls.attribute_filter(t)
-
                 geometryType.append("line") # Galaxy supports both linestring and multilinestring, getting them both since export tool only has line but with galaxy it will also deliver multilinestring features 
-                for part in parts:
-                    part_dict=json.loads(f"""{'{'}{part.strip()}{'}'}""")
-                    for key,value in part_dict.items():
-                        if key not in line_filter:
-                            line_filter[key] = value
-                        else:
-                            line_filter[key] += value
+                cls.merge_parts(line_filter,parts)
             if t.polygons:
                 poly_columns=cls.attribute_filter(t)
                 geometryType.append("polygon" ) # Galaxy also supports multipolygon and polygon , passing them both since export tool has only polygon supported
-                for part in parts:
-                    part_dict=json.loads(f"""{'{'}{part.strip()}{'}'}""")
-                    for key,value in part_dict.items():
-                        if key not in poly_filter:
-                            poly_filter[key] = value
-                        else:
-                            if poly_filter.get(key) != []: #only add other values if not null condition is not applied to that key
-                                if value == [] : # if incoming value is not null i.e. key = * ignore previously added values
-                                    poly_filter[key] = value
-                                else:
-                                    poly_filter[key] += value # if value was not previously = * then and value is not =* then add values 
-
-        if point_filter:
-            point_filter=cls.remove_duplicates(point_filter)
-        if line_filter:
-            line_filter=cls.remove_duplicates(line_filter)
-        if poly_filter:
-            poly_filter=cls.remove_duplicates(poly_filter)
-        return point_filter,line_filter,poly_filter,geometryType,point_columns,line_columns,poly_columns
+                cls.merge_parts(poly_filter,parts,sticky_notnull=True)
 
+        return cls.to_lists(point_filter),cls.to_lists(line_filter),cls.to_lists(poly_filter),geometryType,point_columns,line_columns,poly_columns
+
+    # values are kept as insertion ordered dict keys so merging and de-duplicating stay linear
     @classmethod
-    def remove_duplicates(cls,entries_dict):
-        for key,value in entries_dict.items():
-            entries_dict[key]=list(dict.fromkeys(value))
-        return entries_dict
+    def merge_parts(cls,tag_filter,parts,sticky_notnull=False):
+        for part in parts:
+            for key,value in part.items():
+                if sticky_notnull:
+                    if key in tag_filter and tag_filter[key] is None:
+                        continue # not null condition is already applied to that key, ignore other values
+                    if not value:
+                        tag_filter[key] = None # incoming value is not null i.e. key = * ignore previously added values
+                        continue
+                tag_filter[key].update(dict.fromkeys(value))
+
+    @classmethod
+    def to_lists(cls,tag_filter):
+        return {key:[] if values is None else list(values) for key,values in tag_filter.items()}
 
-    # force quoting of strings to handle keys with colons
     @classmethod
     def parts(cls, expr):
-        def _parts(prefix):
-            op = prefix[0]
-            if op == '=':
-                return [""" "{0}":["{1}"] """.format(prefix[1],prefix[2])]
-            if op == '!=': #fixme this will require improvement in galaxy api is not implemented yet
-                pass
-                # return ["['{0}'!='{1}']".format(prefix[1],prefix[2])]
-            if op in ['<','>','<=','>='] or op == 'notnull':
-                return [""" "{0}":[] """.format(prefix[1])]
-            if op == 'in':
-                x = """ "{0}":["{1}"]""".format(prefix[1],""" "," """.join(prefix[2]))
-                return [x]
-            if op == 'and' or op == 'or':
-                return _parts(prefix[1]) + _parts(prefix[2])
-        return _parts(expr)
+        return list(_parts_cached(_freeze(expr),'galaxy'))
+
+    @classmethod
+    def filters_body(cls,point_filter,line_filter,poly_filter,point_columns,line_columns,poly_columns):
+        # master filter that will be applied to all type of osm elements : current implementation of galaxy api 
+        master_tags = point_filter if point_filter and point_filter == line_filter == poly_filter else None
+        master_columns = point_columns if point_columns and point_columns == line_columns == poly_columns else None
+        if master_tags is not None:
+            tags = {"all_geometry":master_tags}
+        else:
+            tags = {"point":point_filter,"line":line_filter,"polygon":poly_filter}
+        if master_columns is not None:
+            attributes = {"all_geometry":master_columns}
+        else:
+            attributes = {"point":point_columns,"line":line_columns,"polygon":poly_columns}
+        if master_tags is not None and master_columns is None:
+            return {"osmTags":master_tags,"filters":{"tags":tags,"attributes":attributes}}
+        return {"filters":{"tags":tags,"attributes":attributes}}
+
+    # the filters part of a request body only depends on the theme, not on the geometry type or output format
+    @classmethod
+    @_memoized
+    def hdx_theme_body(cls,t):
+        point_filter,line_filter,poly_filter,geometryType,point_columns,line_columns,poly_columns = cls.hdx_filters(t)
+        if len(geometryType) == 0:
+            geometryType=["point","line","polygon"]
+        return geometryType,cls.filters_body(point_filter,line_filter,poly_filter,point_columns,line_columns,poly_columns)
+
+    @classmethod
+    @_memoized
+    def mapping_body(cls,mapping):
+        point_filter,line_filter,poly_filter,geometryType,point_columns,line_columns,poly_columns = cls.filters(mapping)
+        return geometryType,cls.filters_body(point_filter,line_filter,poly_filter,point_columns,line_columns,poly_columns)
+
+    @staticmethod
+    def serialize(request_body, geom_json):
+        # splice in the geometry serialized once per fetch instead of re-encoding its coordinates for every request
+        return b'{"geometry":' + geom_json + b',' + _dumps(request_body)[1:]
 
     @classmethod
     def attribute_filter(cls, theme):
@@ -400,109 +606,101 @@ class Galaxy:
         self.geom = geom
         self.mapping = mapping  
         self.file_name=file_name
+        # converting geom to geojson once, it is shared by every request body
+        if geom.geom_type == 'Polygon':
+            # shapely 2 does this in C without building python tuples
+            if hasattr(shapely,'to_geojson'):
+                self._geom_json = shapely.to_geojson(geom).encode()
+            else:
+                self._geom_json = _dumps(shapely.geometry.mapping(geom))
+        else: #fixme
+            minx, miny, maxx, maxy = geom.bounds
+            west, south, east, north = max(minx,-180), max(miny,-90), min(maxx,180), min(maxy,90)
+            self._geom_json = _dumps('{1},{0},{3},{2}'.format(west, south, east, north))
+        # one session per export so every theme request reuses the same pooled connections
+        self._session = _retrying_session(pool_connections=4,pool_maxsize=16)
 
     def fetch(self,output_format,is_hdx_export=False):
-        if self.geom.geom_type == 'Polygon':
-            geom=shapely.geometry.mapping(self.geom) # converting geom to geojson
-        else: #fixme
-            bounds = self.geom.bounds
-            west = max(bounds[0], -180)
-            south = max(bounds[1], -90)
-            east = min(bounds[2], 180)
-            north = min(bounds[3], 90)
-            geom = '{1},{0},{3},{2}'.format(west, south, east, north)
-          
-        
+        body_prefix = {"outputType":output_format}
+
         if self.mapping:
             if is_hdx_export:
-                fullresponse=[]
+                bodies=[]
                 for t in self.mapping.themes:
-                    point_filter,line_filter,poly_filter,geometryType_filter,point_columns,line_columns,poly_columns = Galaxy.hdx_filters(t)
-                    osmTags=point_filter
-                    if point_filter == line_filter == poly_filter : 
-                        osmTags=point_filter # master filter that will be applied to all type of osm elements : current implementation of galaxy api 
-                    else :
-                        osmTags ={}
-                    if point_columns == line_columns == poly_columns:
-                        columns=point_columns
-                    else :
-                        columns =[]
-                    if len(geometryType_filter) == 0:
-                        geometryType_filter=["point","line","polygon"]
-                    
+                    geometryType_filter,theme_body = Galaxy.hdx_theme_body(t)
                     for geomtype in geometryType_filter:
-                        geomtype_to_pass=[geomtype]
-                        if osmTags: # if it is a master filter i.e. filter same for all type of feature
-                            if columns:
-                                request_body={"fileName":f"""{self.file_name}-{t.name}-{geomtype}""","geometry":geom,"outputType":output_format,"geometryType":geomtype_to_pass,"filters":{"tags":{"all_geometry":osmTags},"attributes":{"all_geometry":columns}}}
-                            else :
-                                request_body={"fileName":f"""{self.file_name}-{t.name}-{geomtype}""","geometry":geom,"outputType":output_format,"geometryType":geomtype_to_pass,"osmTags":osmTags,"filters":{"tags":{"all_geometry":osmTags},"attributes":{"point":point_columns,"line":line_columns,"polygon":poly_columns}}}
-                        else:
-                            if columns:
-                                request_body={"fileName":f"""{self.file_name}-{t.name}-{geomtype}""","geometry":geom,"outputType":output_format,"geometryType":geomtype_to_pass,"filters":{"tags":{"point":point_filter,"line":line_filter,"polygon":poly_filter},"attributes":{"all_geometry":columns}}}
-                            else :
-                                request_body={"fileName":f"""{self.file_name}-{t.name}-{geomtype}""","geometry":geom,"outputType":output_format,"geometryType":geomtype_to_pass,"filters":{"tags":{"point":point_filter,"line":line_filter,"polygon":poly_filter},"attributes":{"point":point_columns,"line":line_columns,"polygon":poly_columns}}}
-                        # sending post request and saving response as response object
-                        headers = {'accept': "application/json","Content-Type": "application/json"}
-                        # print(request_body)
-                        try :
-                            with requests.Session() as req_session:
-                                r=req_session.post(url = self.hostname, data = json.dumps(request_body) ,headers=headers,timeout=60*45)
-                                r.raise_for_status()
-                                if r.ok :
-                                    response_back = r.json()
-                                    response_back['theme'] = t.name
-                                    response_back['output_name'] = output_format
-                                    # print(response_back)
-                                    fullresponse.append(response_back)
-                                else :
-                                    # print(r.content)
-                                    raise ValueError(r.content)
-                        except requests.exceptions.RequestException as e:
-                            raise e
-                            
-                return fullresponse
+                        request_body={"fileName":f"""{self.file_name}-{t.name}-{geomtype}""",**body_prefix,"geometryType":[geomtype],**theme_body}
+                        bodies.append((t.name,request_body))
+
+                # the theme requests are independent and bound by galaxy response time, keep a few in flight
+                def post_one(body):
+                    theme_name,request_body = body
+                    response_back = self._post_one(request_body)
+                    response_back['theme'] = theme_name
+                    response_back['output_name'] = output_format
+                    return response_back
+                if not bodies:
+                    return []
+                return self._post_concurrently(post_one,bodies)
             else:
-                point_filter,line_filter,poly_filter,geometryType_filter,point_columns,line_columns,poly_columns = Galaxy.filters(self.mapping)
-                osmTags=point_filter
-                if point_filter == line_filter == poly_filter : 
-                    osmTags=point_filter # master filter that will be applied to all type of osm elements : current implementation of galaxy api 
-                else :
-                    osmTags ={}
-                if point_columns == line_columns == poly_columns:
-                    columns=point_columns
-                else :
-                    columns =[]
+                geometryType_filter,theme_body = Galaxy.mapping_body(self.mapping)
         else:
             geometryType_filter=[] # if nothing is provided we are getting all type of data back
-        
-        if osmTags: # if it is a master filter i.e. filter same for all type of feature
-            if columns:
-                request_body={"fileName":self.file_name,"geometry":geom,"outputType":output_format,"geometryType":geometryType_filter,"filters":{"tags":{"all_geometry":osmTags},"attributes":{"all_geometry":columns}}}
-            else :
-                request_body={"fileName":self.file_name,"geometry":geom,"outputType":output_format,"geometryType":geometryType_filter,"osmTags":osmTags,"filters":{"tags":{"all_geometry":osmTags},"attributes":{"point":point_columns,"line":line_columns,"polygon":poly_columns}}}
-        else:
-            if columns:
-                request_body={"fileName":self.file_name,"geometry":geom,"outputType":output_format,"geometryType":geometryType_filter,"filters":{"tags":{"point":point_filter,"line":line_filter,"polygon":poly_filter},"attributes":{"all_geometry":columns}}}
-            else :
-                request_body={"fileName":self.file_name,"geometry":geom,"outputType":output_format,"geometryType":geometryType_filter,"filters":{"tags":{"point":point_filter,"line":line_filter,"polygon":poly_filter},"attributes":{"point":point_columns,"line":line_columns,"polygon":poly_columns}}}
+            theme_body={}
+
+        request_body={"fileName":self.file_name,**body_prefix,"geometryType":geometryType_filter,**theme_body}
+        return [self._post_one(request_body)]
+
+    def _post_concurrently(self,post_one,bodies,max_workers=8):
+        # results keep the order of bodies, the first failure is raised right away. the workers are
+        # daemon threads so requests still in flight (up to the 45 minute timeout) are abandoned,
+        # a thread pool would be joined at interpreter exit and keep the process alive behind them
+        pending = queue.Queue()
+        for i,body in enumerate(bodies):
+            pending.put((i,body))
+        done = queue.Queue()
+        failed = threading.Event()
+        def work():
+            while not failed.is_set():
+                try:
+                    i,body = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    done.put((i,post_one(body),None))
+                except BaseException as e:
+                    done.put((i,None,e))
+        for _ in range(min(max_workers,len(bodies))):
+            threading.Thread(target=work,daemon=True).start()
+        results = [None] * len(bodies)
+        for _ in bodies:
+            i,result,error = done.get()
+            if error is not None:
+                failed.set() # nothing new is started
+                self._session.close() # drop the pooled connections
+                raise error
+            results[i] = result
+        return results
+
+    def _post_one(self,request_body):
+        # sending post request and saving response as response object
         headers = {'accept': "application/json","Content-Type": "application/json"}
         # print(request_body)
         try:
-            with requests.Session() as req_session:
-                r=req_session.post(url = self.hostname, data = json.dumps(request_body) ,headers=headers,timeout=60*45)
-                r.raise_for_status()
-                if r.ok :
-                    response_back = r.json()
-                    return [response_back]
-                else :
-                    raise ValueError(r.content)
+            r=self._session.post(url = self.hostname, data = Galaxy.serialize(request_body,self._geom_json) ,headers=headers,timeout=60*45)
+            r.raise_for_status()
+            if r.ok :
+                return r.json()
+            else :
+                # print(r.content)
+                raise ValueError(r.content)
         except requests.exceptions.RequestException as e:
             raise e
 
 
 class Hootenanny:
     @classmethod
+    @_memoized
     def filters(cls,mapping):
         nodes = set()
         ways = set()
@@ -510,34 +708,18 @@ class Hootenanny:
         for t in mapping.themes:
             parts = cls.parts(t.matcher.expr)
             if t.points:
-                for part in parts:
-                    nodes.add(part)
+                nodes.update(parts)
             if t.lines:
-                for part in parts:
-                    ways.add(part)
+                ways.update(parts)
             if t.polygons:
-                for part in parts:
-                    ways.add(part)
-                    relations.add(part)
-        return nodes,ways,relations
+                ways.update(parts)
+                relations.update(parts)
+        # results are cached and shared between callers
+        return frozenset(nodes),frozenset(ways),frozenset(relations)
 
-    # force quoting of strings to handle keys with colons
     @classmethod
     def parts(cls, expr):
-        def _parts(prefix):
-            op = prefix[0]
-            if op == '=':
-                return ["['{0}'='{1}']".format(prefix[1],prefix[2])]
-            if op == '!=':
-                return ["['{0}'!='{1}']".format(prefix[1],prefix[2])]
-            if op in ['<','>','<=','>='] or op == 'notnull':
-                return ["['{0}']".format(prefix[1])]
-            if op == 'in':
-                x = "['{0}'~'{1}']".format(prefix[1],'|'.join(prefix[2]))
-                return [x]
-            if op == 'and' or op == 'or':
-                return _parts(prefix[1]) + _parts(prefix[2])
-        return _parts(expr)
+        return list(_parts_cached(_freeze(expr),'hoot'))
 
     @classmethod
     def sql(cls,str):
@@ -545,6 +727,7 @@ class Hootenanny:
 
     def __init__(self,hostname,geom,path,use_existing=True,mapping=None,extensions=['shp'], name=None, schemas_config = {}, maxGridSize=1.0):
         self.hostname = hostname
+        self._interpreter_url = hostname.rstrip('/') + '/api/interpreter'
         self._path = path
         self.geom = geom
         self.use_existing = use_existing
@@ -557,13 +740,10 @@ class Hootenanny:
     def fetch(self):
         base_template = Template('[out:json][bbox];$query;out meta;')
         if self.geom.geom_type == 'Polygon':
-            geom = ';'.join(['{0},{1}'.format(*x) for x in self.geom.exterior.coords])
+            geom = ';'.join('{0},{1}'.format(x, y) for x, y in np.asarray(self.geom.exterior.coords)[:,:2].tolist())
         else:
-            bounds = self.geom.bounds
-            west = max(bounds[0], -180)
-            south = max(bounds[1], -90)
-            east = min(bounds[2], 180)
-            north = min(bounds[3], 90)
+            minx, miny, maxx, maxy = self.geom.bounds
+            west, south, east, north = max(minx,-180), max(miny,-90), min(maxx,180), min(maxy,90)
             geom = '{1},{0},{3},{2}'.format(west, south, east, north)
 
         if self.mapping:
@@ -587,22 +767,26 @@ class Hootenanny:
 
         data = base_template.substitute(maxsize=2147483648,timeout=1600,query=query)
 
-        # create a temporary file that holds the oql query
-        tmp = tempfile.NamedTemporaryFile();
-        with open(tmp.name, 'w') as f: f.write(data)
+        # create a temporary file that holds the oql query, kept on disk until hoot has read it
+        with tempfile.NamedTemporaryFile('w', delete=False, suffix='.oql') as tmp:
+            tmp.write(data)
+            tmp_name = tmp.name
 
         path_str = self._path
         temp_pbf = os.path.join(path_str, '{0}.osm.pbf'.format(self.name))
 
         parsed_hostname = urlparse(self.hostname).hostname
 
-        subprocess.check_call([
-            'hoot', 'convert', '-D', 'overpass.api.host={0}'.format(parsed_hostname),
-                               '-D', 'overpass.api.query.path={0}'.format(tmp.name),
-                               '-D', 'bounds={0}'.format(geom),
-                               '-D', 'reader.http.bbox.max.download.size={0}'.format(self.maxGridSize), # override api read limit
-                                os.path.join(self.hostname, 'api', 'interpreter'), temp_pbf
-        ])
+        try:
+            subprocess.check_call([
+                'hoot', 'convert', '-D', 'overpass.api.host={0}'.format(parsed_hostname),
+                                   '-D', 'overpass.api.query.path={0}'.format(tmp_name),
+                                   '-D', 'bounds={0}'.format(geom),
+                                   '-D', 'reader.http.bbox.max.download.size={0}'.format(self.maxGridSize), # override api read limit
+                                    self._interpreter_url, temp_pbf
+            ])
+        finally:
+            os.remove(tmp_name)
 
         for ext in self.extensions:
             for schema in self.schemas_config:
@@ -10,6 +10,7 @@ requirements = [
     'pyparsing',
     'pyyaml',
     'shapely',
+    'numpy',
     'requests',
     'landez'
 ]
@@ -32,6 +33,7 @@ setuptools.setup(
     ],
     scripts=['bin/osm-export-tool'],
     install_requires = requirements,
+    extras_require = {'orjson':['orjson']},
     requires_python='>=3.0',
     package_data={'osm_export_tool':['mappings/*.yml']}
 )
@@ -1,5 +1,16 @@
+import io
+import json
+import os
+import sys
+import tempfile
+import subprocess
+import time
 import unittest
-from osm_export_tool.sources import Overpass
+from unittest import mock
+import requests
+from shapely.geometry import box
+from urllib3.exceptions import ProtocolError
+from osm_export_tool.sources import Overpass, Galaxy, _ResumableResponse, _retrying_session
 from osm_export_tool.mapping import Mapping
 
 class TestMappingToOverpass(unittest.TestCase):
@@ -34,6 +45,34 @@ class TestMappingToOverpass(unittest.TestCase):
         self.assertCountEqual(ways,["['column5:key']","['column3'~'foo|bar']","['column2']"])
         self.assertCountEqual(relations,["['column3'~'foo|bar']","['column2']"])
 
+    def test_union_mapping(self):
+        y = '''
+        all:
+            select:
+                - column1
+            where: column1 IS NOT NULL
+
+        other1:
+            types:
+                - points
+            select:
+                - column2
+            where: column2 IS NOT NULL
+
+        other2:
+            types:
+                - polygons
+            select:
+                - column3
+            where: column3 IS NOT NULL
+        '''
+        mapping = Mapping(y)
+        nwr, nodes, ways, relations = Overpass.union_filters(mapping)
+        self.assertCountEqual(nwr,["['column1']"])
+        self.assertCountEqual(nodes,["['column2']"])
+        self.assertCountEqual(ways,["['column3']"])
+        self.assertCountEqual(relations,["['column3']"])
+
 class TestSQLToOverpass(unittest.TestCase):
     def test_basic(self):
         s = Overpass.sql("name = 'somename'")
@@ -57,4 +96,384 @@ class TestSQLToOverpass(unittest.TestCase):
         s = Overpass.sql("name1 = 'foo' or name2 = 'bar'")
         self.assertEqual(s,["['name1'='foo']","['name2'='bar']"])
         s = Overpass.sql("(name1 = 'foo' and name2 = 'bar') or name3 = 'baz'")
-        self.assertEqual(s,["['name1'='foo']","['name2'='bar']","['name3'='baz']"])
\ No newline at end of file
+        self.assertEqual(s,["['name1'='foo']","['name2'='bar']","['name3'='baz']"])
+
+class TestOverpassSample(unittest.TestCase):
+    def test_valid(self):
+        head = b'<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n<note>The data included in this document is from www.openstreetmap.org.</note>\n'
+        Overpass.check_sample(head)
+
+    def test_html(self):
+        head = b'<?xml version="1.0" encoding="UTF-8"?>\n<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN">\n'
+        with self.assertRaises(Exception):
+            Overpass.check_sample(head)
+
+    def test_remark(self):
+        head = b'<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n<note/>\n<meta/>\n\n  <remark> runtime error: Query timed out </remark>\n'
+        with self.assertRaisesRegex(Exception,'runtime error'):
+            Overpass.check_sample(head)
+
+class TestFiltersCache(unittest.TestCase):
+    def test_cached_per_mapping(self):
+        y = '''
+        buildings:
+            select:
+                - building
+            where: building IN ('yes','house')
+        '''
+        mapping = Mapping(y)
+        self.assertIs(Overpass.filters(mapping),Overpass.filters(mapping))
+        self.assertIsNot(Overpass.filters(mapping),Overpass.filters(Mapping(y)))
+        self.assertEqual(Overpass.parts(mapping.themes[0].matcher.expr),["['building'~'yes|house']"])
+
+class TestMappingToGalaxy(unittest.TestCase):
+    def test_parts(self):
+        self.assertEqual(Galaxy.parts(('=','building','yes')),[{'building':['yes']}])
+        self.assertEqual(Galaxy.parts(('notnull','name')),[{'name':[]}])
+        self.assertEqual(Galaxy.parts(('in','amenity',['school','college'])),[{'amenity':['school','college']}])
+
+    def test_hdx_filters(self):
+        y = '''
+        education:
+            types:
+                - points
+                - polygons
+            select:
+                - name
+                - amenity
+            where: amenity IN ('school','college') OR amenity = 'school' OR building IS NOT NULL
+        '''
+        theme = Mapping(y).themes[0]
+        point_filter,line_filter,poly_filter,geometryType,point_columns,line_columns,poly_columns = Galaxy.hdx_filters(theme)
+        self.assertEqual(point_filter,{'amenity':['school','college'],'building':[]})
+        self.assertEqual(line_filter,{})
+        self.assertEqual(poly_filter,{'amenity':['school','college'],'building':[]})
+        self.assertEqual(geometryType,['point','polygon'])
+        self.assertCountEqual(point_columns,['name','amenity'])
+        self.assertEqual(line_columns,[])
+        # the cached parts must not be mutated by merging
+        self.assertEqual(Galaxy.parts(theme.matcher.expr),[{'amenity':['school','college']},{'amenity':['school']},{'building':[]}])
+
+    def test_polygon_notnull_sticky(self):
+        y = '''
+        buildings:
+            types:
+                - points
+                - polygons
+            select:
+                - building
+            where: building = 'yes' OR building IS NOT NULL OR building = 'house'
+        '''
+        theme = Mapping(y).themes[0]
+        point_filter,line_filter,poly_filter = Galaxy.hdx_filters(theme)[:3]
+        self.assertEqual(point_filter,{'building':['yes','house']})
+        self.assertEqual(poly_filter,{'building':[]})
+
+    def test_filters_body(self):
+        tags = {'building':[]}
+        body = Galaxy.filters_body(tags,tags,tags,['name'],['name'],['name'])
+        self.assertEqual(body,{'filters':{'tags':{'all_geometry':tags},'attributes':{'all_geometry':['name']}}})
+        body = Galaxy.filters_body(tags,{},tags,['name'],[],['name'])
+        self.assertEqual(body['filters']['tags'],{'point':tags,'line':{},'polygon':tags})
+        self.assertEqual(body['filters']['attributes'],{'point':['name'],'line':[],'polygon':['name']})
+
+    def test_serialize(self):
+        geom_json = b'{"type":"Polygon","coordinates":[[[0.0,0.0],[1.0,0.0],[1.0,1.0],[0.0,0.0]]]}'
+        body = Galaxy.serialize({"fileName":"test","geometryType":["point"]},geom_json)
+        self.assertEqual(json.loads(body),{"geometry":json.loads(geom_json),"fileName":"test","geometryType":["point"]})
+
+class TestOverpassConvert(unittest.TestCase):
+    def test_xml_output(self):
+        self.assertTrue(Overpass('http://overpass',None,'out.osm.xml',tempdir='tmp').xml_output())
+        self.assertFalse(Overpass('http://overpass',None,'out.osm.pbf',tempdir='tmp').xml_output())
+
+    def test_osmconvert_fallback(self):
+        source = Overpass('http://overpass',None,'out.osm.pbf',tempdir='tmp',osmium_path='/nonexistent/osmium')
+        self.assertEqual(source.convert_cmd('-','out.osm.pbf'),['osmconvert','-','--out-pbf','-o=out.osm.pbf'])
+
+    def test_interpreter_url(self):
+        self.assertEqual(Overpass('http://overpass/',None,'out.osm.pbf',tempdir='tmp')._interpreter_url,'http://overpass/api/interpreter')
+
+class TestOverpassQuery(unittest.TestCase):
+    def test_polygon_once(self):
+        y = '''
+        buildings:
+            select:
+                - building
+            where: building IS NOT NULL
+        roads:
+            types:
+                - lines
+            select:
+                - highway
+            where: highway IS NOT NULL
+        '''
+        geom = 'poly:"{0}"'.format(' '.join(['0.123456789 1.123456789'] * 30000))
+        query = Overpass.mapping_query(Mapping(y),'0,0,1,1',geom)
+        self.assertEqual(query.count(geom),1)
+        self.assertIn("nwr(0,0,1,1)['building'];",query)
+        self.assertIn("way(0,0,1,1)['highway'];",query)
+        self.assertIn('nwr.candidates({0});'.format(geom),query)
+
+    def test_small_polygon_per_statement(self):
+        y = '''
+        buildings:
+            select:
+                - building
+            where: building IS NOT NULL
+        '''
+        geom = 'poly:"0 0 0 1 1 1 0 0"'
+        query = Overpass.mapping_query(Mapping(y),'0,0,1,1',geom)
+        self.assertIn("nwr({0})['building'];".format(geom),query)
+        self.assertNotIn('0,0,1,1',query)
+        self.assertIn('.candidates;',query)
+
+class CopyConverter(Overpass):
+    # stands in for osmium/osmconvert, copies stdin to the output
+    def convert_cmd(self, source, output):
+        return [sys.executable,'-c','import shutil,sys; shutil.copyfileobj(sys.stdin.buffer,open(sys.argv[1],"wb"))',output]
+
+class FailingReader:
+    def __init__(self,chunks):
+        self.chunks = list(chunks)
+
+    def read(self,amt=None):
+        if not self.chunks:
+            raise ConnectionError('connection dropped')
+        return self.chunks.pop(0)
+
+class TestOverpassConvertStream(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+
+    def source(self,name):
+        return CopyConverter('http://overpass',None,os.path.join(self.tempdir.name,name),tempdir=self.tempdir.name)
+
+    def test_complete(self):
+        source = self.source('out.osm.pbf')
+        partial = source.convert_stream(b'<osm>',io.BytesIO(b'</osm>'))
+        with open(partial,'rb') as f:
+            self.assertEqual(f.read(),b'<osm></osm>')
+
+    def test_failing_stream_leaves_no_output(self):
+        source = self.source('out.osm.pbf')
+        with self.assertRaises(ConnectionError):
+            source.convert_stream(b'<osm>',FailingReader([b'<node/>',b'<node/>']))
+        self.assertEqual(os.listdir(self.tempdir.name),[])
+
+    def test_failing_xml_stream_leaves_no_output(self):
+        source = self.source('out.osm.xml')
+        with self.assertRaises(ConnectionError):
+            source.convert_stream(b'<osm>',FailingReader([b'<node/>']))
+        self.assertEqual(os.listdir(self.tempdir.name),[])
+
+class MockRaw:
+    # serves data, then drops the connection once fail_at bytes have been read
+    def __init__(self,data,fail_at=None):
+        self.data = data
+        self.pos = 0
+        self.fail_at = fail_at
+
+    def read(self,amt=None):
+        end = len(self.data) if self.fail_at is None else self.fail_at
+        if self.pos >= end and self.fail_at is not None:
+            raise ProtocolError('Connection broken: IncompleteRead')
+        chunk = self.data[self.pos:min(end,self.pos + (amt or len(self.data)))]
+        self.pos += len(chunk)
+        return chunk
+
+class MockResponse:
+    def __init__(self,raw,status_code=200,headers=None):
+        self.raw = raw
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def close(self):
+        pass
+
+class MockSession:
+    def __init__(self,*responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def post(self,url,data,headers,stream):
+        self.requests.append(headers)
+        return self.responses.pop(0)
+
+BODY = b'<osm>' + b'<node/>' * 20 + b'</osm>'
+FIRST = {'Accept-Ranges':'bytes','ETag':'"abc"'}
+
+class TestResumableResponse(unittest.TestCase):
+    def read_all(self,response):
+        out = b''
+        while True:
+            chunk = response.read(16)
+            if not chunk:
+                return out
+            out += chunk
+
+    def test_resume(self):
+        session = MockSession(
+            MockResponse(MockRaw(BODY,fail_at=40),headers=FIRST),
+            MockResponse(MockRaw(BODY[40:]),206,{'Content-Range':'bytes 40-{0}/{1}'.format(len(BODY)-1,len(BODY))}))
+        r = _ResumableResponse(session,'http://overpass/api/interpreter',b'query',{'Accept-Encoding':'gzip, deflate'})
+        self.assertEqual(self.read_all(r),BODY)
+        self.assertEqual(session.requests[1],{'Accept-Encoding':'identity','Range':'bytes=40-','If-Range':'"abc"'})
+
+    def test_no_validator(self):
+        session = MockSession(MockResponse(MockRaw(BODY,fail_at=40),headers={'Accept-Ranges':'bytes','ETag':'W/"abc"'}))
+        r = _ResumableResponse(session,'http://overpass/api/interpreter',b'query',{})
+        with self.assertRaises(ProtocolError):
+            self.read_all(r)
+        self.assertEqual(len(session.requests),1)
+
+    def test_compressed_first_response(self):
+        session = MockSession(MockResponse(MockRaw(BODY,fail_at=40),headers={**FIRST,'Content-Encoding':'gzip'}))
+        r = _ResumableResponse(session,'http://overpass/api/interpreter',b'query',{})
+        with self.assertRaises(ProtocolError):
+            self.read_all(r)
+
+    def test_refused_range(self):
+        # a changed result comes back whole with 200
+        session = MockSession(
+            MockResponse(MockRaw(BODY,fail_at=40),headers=FIRST),
+            MockResponse(MockRaw(BODY),200))
+        r = _ResumableResponse(session,'http://overpass/api/interpreter',b'query',{})
+        with self.assertRaisesRegex(ValueError,'did not resume'):
+            self.read_all(r)
+
+    def test_compressed_resume(self):
+        session = MockSession(
+            MockResponse(MockRaw(BODY,fail_at=40),headers=FIRST),
+            MockResponse(MockRaw(b'gzipped'),206,{'Content-Range':'bytes 40-96/97','Content-Encoding':'gzip'}))
+        r = _ResumableResponse(session,'http://overpass/api/interpreter',b'query',{})
+        with self.assertRaisesRegex(ValueError,'Content-Encoding'):
+            self.read_all(r)
+
+    def test_wrong_offset(self):
+        session = MockSession(
+            MockResponse(MockRaw(BODY,fail_at=40),headers=FIRST),
+            MockResponse(MockRaw(BODY[32:]),206,{'Content-Range':'bytes 32-{0}/{1}'.format(len(BODY)-1,len(BODY))}))
+        r = _ResumableResponse(session,'http://overpass/api/interpreter',b'query',{})
+        with self.assertRaisesRegex(ValueError,'expected byte 40'):
+            self.read_all(r)
+
+class TestRetryingSession(unittest.TestCase):
+    def test_retry_settings(self):
+        session = _retrying_session(pool_connections=4,pool_maxsize=16)
+        for prefix in ('http://','https://'):
+            retry = session.adapters[prefix].max_retries
+            self.assertEqual(retry.total,5)
+            self.assertIs(retry.read,False)
+            self.assertEqual(set(retry.status_forcelist),{429,502,503})
+            self.assertTrue(retry.respect_retry_after_header)
+            self.assertTrue(retry.is_retry('POST',503))
+            self.assertFalse(retry.is_retry('POST',504))
+
+class MockGalaxyResponse:
+    ok = True
+
+    def __init__(self,body):
+        self.body = body
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return {'fileName':self.body['fileName']}
+
+class MockGalaxySession:
+    def __init__(self,fail=None,delay=0):
+        self.fail = fail
+        self.delay = delay
+
+    def post(self,url,data,headers,timeout):
+        body = json.loads(data)
+        if body['fileName'] == self.fail:
+            raise requests.exceptions.ConnectionError('galaxy is down')
+        time.sleep(self.delay)
+        return MockGalaxyResponse(body)
+
+    def close(self):
+        pass
+
+# fails one theme while the others are still in flight, the process must exit without waiting for them
+FAIL_FAST_SCRIPT = '''
+import sys
+from shapely.geometry import box
+from osm_export_tool.mapping import Mapping
+from osm_export_tool.sources import Galaxy
+from test.test_sources import MockGalaxySession, TestGalaxyFetch
+galaxy = Galaxy('http://galaxy',box(0,0,1,1),mapping=Mapping(TestGalaxyFetch.y),file_name='export')
+galaxy._session = MockGalaxySession(fail='export-buildings-polygon',delay=6)
+try:
+    galaxy.fetch('geojson',is_hdx_export=True)
+except Exception as e:
+    print(type(e).__name__)
+'''
+
+class TestGalaxyFetch(unittest.TestCase):
+    y = '''
+    roads:
+        types:
+            - lines
+        select:
+            - highway
+        where: highway IS NOT NULL
+    buildings:
+        types:
+            - points
+            - polygons
+        select:
+            - building
+        where: building IS NOT NULL
+    '''
+
+    def test_hdx_order(self):
+        galaxy = Galaxy('http://galaxy',box(0,0,1,1),mapping=Mapping(self.y),file_name='export')
+        galaxy._session = MockGalaxySession()
+        response = galaxy.fetch('geojson',is_hdx_export=True)
+        self.assertEqual([r['fileName'] for r in response],['export-roads-line','export-buildings-point','export-buildings-polygon'])
+        self.assertEqual([r['theme'] for r in response],['roads','buildings','buildings'])
+        self.assertEqual({r['output_name'] for r in response},{'geojson'})
+
+    def test_hdx_fails_fast(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        start = time.monotonic()
+        out = subprocess.run([sys.executable,'-c',FAIL_FAST_SCRIPT],cwd=root,stdout=subprocess.PIPE,check=True).stdout
+        # the other requests are held for 6 seconds, neither the error nor the exit may wait for them
+        self.assertLess(time.monotonic() - start,4)
+        self.assertEqual(out.strip(),b'ConnectionError')
+
+class FailingConverter(Overpass):
+    def convert_cmd(self, source, output):
+        return [sys.executable,'-c','import sys; sys.stdin.buffer.read(); sys.exit(1)']
+
+class TestOverpassCurl(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.bindir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.bindir.cleanup)
+
+    def fetch(self,cls,curl_script):
+        # puts a fake curl first on the PATH
+        curl = os.path.join(self.bindir.name,'curl')
+        with open(curl,'w') as f:
+            f.write('#!/bin/sh\n' + curl_script)
+        os.chmod(curl,0o755)
+        source = cls('http://overpass',box(0,0,1,1),os.path.join(self.tempdir.name,'out.osm.pbf'),tempdir=self.tempdir.name,use_curl=True)
+        with mock.patch.dict(os.environ,{'PATH':self.bindir.name + os.pathsep + os.environ['PATH']}):
+            with self.assertRaises(subprocess.CalledProcessError) as cm:
+                source.fetch()
+        self.assertEqual(os.listdir(self.tempdir.name),['query.txt'])
+        return cm.exception
+
+    def test_http_error(self):
+        e = self.fetch(CopyConverter,'exit 22\n')
+        self.assertEqual(e.returncode,22)
+
+    def test_curl_failure_behind_converter_failure(self):
+        e = self.fetch(FailingConverter,'printf "<?xml?>\\n<osm>\\n"\nexit 18\n')
+        self.assertEqual(e.returncode,18)